@@ -13,19 +13,50 @@ Arguments:
     --key   : Base64-encoded 32-byte string used to decrypt API tokens.
 """
 import re
+import string
 import sys
 
-import datetime
 import os
+import shutil
+import uuid
 import pandas as pd
-import requests
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from cryptography.fernet import Fernet
-from io import StringIO
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+# works both as part of the scripts package and when run from inside scripts/
+try:
+    from .redcapUtils import POOL_SIZE, REDCAP_API_URL, get_session, is_true, read_metadata
+except ImportError:
+    from redcapUtils import POOL_SIZE, REDCAP_API_URL, get_session, is_true, read_metadata
 import time
 import argparse
 import getpass
 
-REDCAP_API_URL = "https://redcap.fiu.edu/api/"
+# pyarrow is optional and only used with --arrow, which changes the CSV format
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
+# dtype_backend="pyarrow" requires pandas 2.0+
+ARROW_DTYPES_SUPPORTED = pa is not None and int(pd.__version__.split(".")[0]) >= 2
+
+# number of concurrent REDCap API requests
+MAX_WORKERS = 8
+# number of threads parsing responses and writing CSV files
+PROCESS_WORKERS = 4
+
+# progress bar: slicing this string yields every fill level of a default-length bar
+_BAR_LENGTH = 40
+_BAR_CACHE = '█' * _BAR_LENGTH + '-' * _BAR_LENGTH
+_last_progress = None
+
+# project name clean-up used by format_fileName
+_REMOTE_RE = re.compile(r'_REMOTE-ONLY$')
+_STRIP_TABLE = str.maketrans('', '', '_' + string.whitespace)
 
 COLOR_MAP = {
     "red": "\033[91m",
@@ -45,14 +76,23 @@ def getData(api_token):
         "type": "flat",
         "exportSurveyFields": "true"
     }
-    response = requests.post(REDCAP_API_URL, data=data)
+    response = get_session().post(REDCAP_API_URL, data=data, stream=True)
     if response.status_code != 200:
         raise Exception(f"Error fetching data: {response.status_code} - {response.text}")
+    # let urllib3 undo any gzip/deflate encoding when pandas reads the raw stream
+    response.raw.decode_content = True
     return response
 
-def transformData(response):
-    """ Transforms the raw CSV response from REDCap into a cleaned DataFrame. """
-    created_df = pd.read_csv(StringIO(response))
+def transformData(response, use_arrow=False):
+    """ Transforms the streamed CSV response from REDCap into a cleaned DataFrame. """
+    try:
+        if response.headers.get("Content-Length") == "0":
+            raise pd.errors.EmptyDataError("Empty response body")
+        read_kwargs = {"dtype_backend": "pyarrow"} if use_arrow and ARROW_DTYPES_SUPPORTED else {}
+        created_df = pd.read_csv(response.raw, engine="c", low_memory=False, **read_kwargs)
+    finally:
+        # release the connection back to the session pool
+        response.close()
     # if the columns are numbers, then set the first row as header
     if  all(isinstance(c, int) for c in created_df.columns):
         created_df.columns = created_df.iloc[0]
@@ -73,11 +113,15 @@ def create_typing_effect(text, delay=0.01, color="blue"):
     :param color: Color of the text
     """
     color_code = COLOR_MAP.get(color, COLOR_MAP["red"])
+    if delay <= 0:
+        # no typing effect requested, write the whole line at once
+        sys.stdout.write(f"{color_code}{text}{COLOR_MAP['reset']}\n")
+        sys.stdout.flush()
+        return
     for char in text:
         sys.stdout.write(f"{color_code}{char}{COLOR_MAP['reset']}")
         sys.stdout.flush()
-        if delay > 0:
-            time.sleep(delay)
+        time.sleep(delay)
     sys.stdout.write('\n')
 
 def parseArgs():
@@ -86,81 +130,159 @@ def parseArgs():
     parser.add_argument('--key', type=str, help='Decryption key (base64-encoded 32-byte string)')
     parser.add_argument('--no_clears', action='store_true', help='Do not clear existing files in target directories before extraction.')
     parser.add_argument('--isDirect', action='store_true', help='Uploads data directly without saving CSV files elsewhere.')
+    parser.add_argument('--arrow', action='store_true', help='Parse and write CSVs with pyarrow (quotes strings, writes 3.0 as 3 and booleans as true/false).')
     # Add more arguments as needed
     if not sys.argv[1:]:
         parser.print_help()
         sys.exit(1)
     return parser.parse_args()
 
+@lru_cache(maxsize=256)
+def format_date(date):
+    """
+    Formats an HTTP Date header for use in file names.
+    Responses finishing in the same second share the header, so results are cached.
+    
+    :param date: Date string from the response headers (RFC 1123)
+    :return: Date formatted as YYYY-MM-DD_HHMM
+    """
+    return parsedate_to_datetime(date).strftime('%Y-%m-%d_%H%M')
+
 def format_fileName(date, df):
     """
     Formats the file name based on project details and date.
     
     :param date: Date string from the response headers
-    :param df: DataFrame row containing project details
+    :param df: Mapping of a metadata row containing project details
     :return: Formatted file name as a string
     """
-    dt = datetime.datetime.strptime(date, '%a, %d %b %Y %H:%M:%S %Z')
-    date_str = dt.strftime('%Y-%m-%d_%H%M')
-    if  pd.isna(df["project_name"]):
+    date_str = format_date(date)
+    if not df["project_name"]:
         raise ValueError("Project name cannot be empty for file naming.")
     project_name = df["project_name"]
-    project_name = df.get("project_name", "UnknownProject")
-    if df["custom_name"] != "" and not pd.isna(df["custom_name"]):
+    if df.get("custom_name"):
         project_name = df["custom_name"]
         print(f"Using custom name {project_name} for project {df['project_name']} in file naming.")
     # format file name by removing any underscores in project name
     # check to see if the project ends with REMOTE_ONLY, replace it with just R
     print(f"Original project name: {project_name}")
-    project_name = re.sub(r'_REMOTE-ONLY$', '', project_name)
-    project_name = re.sub(r'[_\s]+', '', project_name)
+    project_name = _REMOTE_RE.sub('', project_name)
+    project_name = project_name.translate(_STRIP_TABLE)
     project_name = project_name[0].upper() + project_name[1:] if len(project_name) > 0 else project_name
     project_type = df.get("project_type", "DATA")
     return f"{project_name}_{project_type}_{date_str}.csv"
 
 
-def decrypt_token(encrypted_token, key):
+def decrypt_token(encrypted_token, cipher):
     """
-    Decrypts the given encrypted API token using the provided key.
+    Decrypts the given encrypted API token using the provided cipher.
     
     :param encrypted_token: The encrypted API token to decrypt
-    :param key: The decryption key (base64-encoded 32-byte string)
+    :param cipher: Fernet cipher built from the decryption key
     :return: Decrypted API token as a string
     """
     if encrypted_token is None or encrypted_token == "":
         raise ValueError("API token cannot be empty for decryption.")
-    cipher = Fernet(key.encode())
     decrypted_token = cipher.decrypt(encrypted_token).decode()
     return decrypted_token
 
-def create_csv(df, file_name,folder_path,isDirect=False):
+def decrypt_tokens(encrypted_tokens, key):
+    """
+    Decrypts a list of encrypted API tokens with a single cipher.
+    
+    :param encrypted_tokens: List of encrypted API tokens
+    :param key: The decryption key (base64-encoded 32-byte string, as bytes)
+    :return: List of decrypted API tokens in the same order
+    """
+    cipher = Fernet(key)
+    return [decrypt_token(token, cipher) for token in encrypted_tokens]
+
+def create_csv(df, file_name,folder_path,use_arrow=False):
     """
     Creates a CSV file from the given DataFrame in the specified folder path.
+    The folder is expected to exist already (see ensure_folder).
     
     :param df: DataFrame to be saved as CSV
     :param file_name: Name of the CSV file
     :param folder_path: Folder path where the CSV file will be saved
+    :param use_arrow: Write with pyarrow instead of DataFrame.to_csv
     :return: Path to the created CSV file
     """
 
-    if not os.path.exists(folder_path):
-        if isDirect:
-            raise FileNotFoundError(f"The folder path {folder_path} does not exist.")
-        else:
-            os.makedirs(folder_path)
     file_path = os.path.join(folder_path, file_name)
-    # check if file already exists
-    if os.path.exists(file_path):
-        print(f"File {file_path} already exists. Overwriting.")
-    df.to_csv(file_path, index=False)
+    tmp_path = _temp_path(file_path)
+    try:
+        if use_arrow:
+            pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+        else:
+            df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        _discard(tmp_path)
+        raise
+    return file_path
+
+def link_csv(source_path, folder_path):
+    """
+    Places an already written CSV file into another folder path, hard linking it
+    when possible and copying it otherwise (e.g. across filesystems).
+    
+    :param source_path: Path to the CSV file that was already written
+    :param folder_path: Folder path where the CSV file should also appear
+    :return: Path to the linked or copied CSV file
+    """
+    file_path = os.path.join(folder_path, os.path.basename(source_path))
+    tmp_path = _temp_path(file_path)
+    try:
+        try:
+            os.link(source_path, tmp_path)
+        except OSError:
+            shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        _discard(tmp_path)
+        raise
     return file_path
 
+def _temp_path(file_path):
+    # writers fill a unique temp file next to the target and os.replace it into place,
+    # so two jobs writing the same path never see it missing or half written, and
+    # hard-linked copies in other folders are never modified in place
+    folder_path, file_name = os.path.split(file_path)
+    return os.path.join(folder_path, f".{file_name}.{uuid.uuid4().hex}.tmp")
+
+def _discard(file_path):
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+
+def ensure_folder(folder_path, isDirect=False):
+    """
+    Makes sure the folder path exists, creating it unless running in direct mode.
+    
+    :param folder_path: Folder path to check
+    :param isDirect: Raise instead of creating the folder when True
+    """
+    if isDirect:
+        if not os.path.isdir(folder_path):
+            raise FileNotFoundError(f"The folder path {folder_path} does not exist.")
+    else:
+        os.makedirs(folder_path, exist_ok=True)
+
 def update_progress_bar(total=100, length=40,progress=0, color="green"):
+    global _last_progress
     i =progress
-    color_code = COLOR_MAP.get(color, COLOR_MAP["reset"])
     percent = int(100 * i / total)
     filled_length = int(length * i // total)
-    bar = '█' * filled_length + '-' * (length - filled_length)
+    # only redraw when the visible bar or percentage changes
+    state = (total, length, percent, filled_length)
+    if state == _last_progress:
+        return
+    _last_progress = state
+    color_code = COLOR_MAP.get(color, COLOR_MAP["reset"])
+    bar_cache = _BAR_CACHE if length == _BAR_LENGTH else '█' * length + '-' * length
+    bar = bar_cache[length - filled_length:2 * length - filled_length]
     sys.stdout.write(f'\r{color_code}|{bar}| {percent}%{COLOR_MAP["reset"]}')
     sys.stdout.flush()
 
@@ -172,21 +294,58 @@ def clear_files(folder_paths):
     """
     for folder_path in folder_paths:
         if not os.path.exists(folder_path):
-            return
-        for filename in os.listdir(folder_path):
-            file_path = os.path.join(folder_path, filename)
-            try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-                else:
-                    print(f"Skipping {file_path} as it is not a file.")
-            except Exception as e:
-                print(f"Error deleting file {file_path}: {e}")
+            continue
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        os.unlink(entry.path)
+                    else:
+                        print(f"Skipping {entry.path} as it is not a file.")
+                except Exception as e:
+                    print(f"Error deleting file {entry.path}: {e}")
 
 
+def _process_project(row, response, file_name, folder_paths, use_arrow=False):
+    """
+    Parses a fetched REDCap response and writes it to the project's folder(s).
+    Runs on a worker thread, so it does not print.
+    
+    :param row: Mapping of the metadata row for the project
+    :param response: Streamed response returned by getData
+    :param file_name: Name of the CSV file, from format_fileName
+    :param folder_paths: Folders to write the CSV file into
+    :param use_arrow: Parse and write the CSV with pyarrow
+    """
+    try:
+        created_df = transformData(response, use_arrow=use_arrow)
+    except pd.errors.EmptyDataError:
+        raise ValueError(f"No data returned for project {row['project_name']}.")
+    # serialize once, then link the file into the remaining folders
+    if folder_paths:
+        first_path = create_csv(created_df, file_name, folder_paths[0], use_arrow=use_arrow)
+        for path in folder_paths[1:]:
+            link_csv(first_path, path)
+
+def _close_unread_responses(fetches, writes):
+    """
+    Closes streamed responses that were fetched but never parsed, e.g. after a failure.
+    
+    :param fetches: Mapping of finished or cancelled fetch futures to metadata rows
+    :param writes: Mapping of write futures to the responses they were given
+    """
+    for future in fetches:
+        if future.done() and not future.cancelled() and future.exception() is None:
+            future.result().close()
+    for response in writes.values():
+        response.close()
+
 def main(args):
     create_typing_effect("Welcome to the REDCap ETL Extractor!\n", color="red")
     isDirect = args.isDirect
+    use_arrow = args.arrow
+    if use_arrow and pa is None:
+        raise ValueError("--arrow requires pyarrow to be installed.")
     #print(f"Arguments received: {args}")
     key = args.key
     if key is None:
@@ -197,40 +356,77 @@ def main(args):
             key = getpass.getpass("Enter the decryption key (base64-encoded 32-byte string): ")
     if len(key) != 44:
         raise ValueError("Decryption key must be a base64-encoded 32-byte string.")
-    api_df = pd.read_csv(args.input)
-    # get number of rows in the dataframe
-    total_rows = len(api_df)
+    _, api_rows = read_metadata(args.input)
+    # get number of projects in the metadata file
+    total_rows = len(api_rows)
     create_typing_effect(f"Starting extraction for {total_rows} projects...\n", color="yellow")
+    # unique target folders, excluding the "all" placeholder; every row writes into these
+    all_folders = tuple(dict.fromkeys(row["folder_path"] for row in api_rows if row["folder_path"] != "all"))
     if args.no_clears == False:
         if isDirect == True:
             raise ValueError("Cannot clear files in direct mode.")
-        folder_paths = api_df["folder_path"].unique()
-        # remove "all" from folder_paths
-        folder_paths = [path for path in folder_paths if path != "all"]
         create_typing_effect("Clearing existing files in target directories...\n", color="yellow")
-        clear_files(folder_paths)
+        clear_files(all_folders)
         print("Existing files cleared.\n")
-    for index, row in api_df.iterrows():
-        update_progress_bar(total=total_rows, progress=index+1, color="white")
-        if row["encrypted"] == False:
+    # create (or in direct mode, check) each folder once instead of per written file
+    for folder_path in all_folders:
+        ensure_folder(folder_path, isDirect=isDirect)
+    for row in api_rows:
+        if not is_true(row["encrypted"]):
             raise ValueError(f"API token for project {row['project_name']} is not encrypted. Please encrypt it before proceeding.")
-        decrypted_token = decrypt_token(row["API_Token"], key)
-        response = getData(decrypted_token)
-        # check if response is empty
-        if not response.text.strip():
-            raise ValueError(f"No data returned for project {row['project_name']}.")
-        date = response.headers['Date']
-        created_df = transformData(response.text)
-        file_name = format_fileName(date, row)
-        # check if the folder path is "all" for downloading to all folders 
-        if row["folder_path"] == "all":
-            uniquePaths = api_df["folder_path"].unique()
-            # remove "all" from uniquePaths
-            uniquePaths = [path for path in uniquePaths if path != "all"]
-            for path in uniquePaths:
-                create_csv(created_df, file_name, path, isDirect=isDirect)
-        else:
-            create_csv(created_df, file_name, row["folder_path"], isDirect=isDirect)
+    tokens = decrypt_tokens([row["API_Token"] for row in api_rows], key.encode())
+    jobs = iter(zip(api_rows, tokens))
+    completed = 0
+    # each project between fetch and write holds an unread streamed response, so cap
+    # them at the session's pool size and only start new fetches below that
+    max_in_flight = POOL_SIZE
+    fetches = {}  # fetch future -> metadata row
+    writes = {}  # write future -> response it parses
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as fetch_executor, \
+                ThreadPoolExecutor(max_workers=PROCESS_WORKERS) as process_executor:
+            try:
+                while True:
+                    while len(fetches) + len(writes) < max_in_flight:
+                        job = next(jobs, None)
+                        if job is None:
+                            break
+                        row, token = job
+                        fetches[fetch_executor.submit(getData, token)] = row
+                    if not fetches and not writes:
+                        break
+                    done, _ = wait([*fetches, *writes], return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future in fetches:
+                            response = future.result()
+                            row = fetches.pop(future)
+                            try:
+                                # name the file here so its messages print on the main thread
+                                file_name = format_fileName(response.headers['Date'], row)
+                            except BaseException:
+                                response.close()
+                                raise
+                            # check if the folder path is "all" for downloading to all folders
+                            targets = all_folders if row["folder_path"] == "all" else (row["folder_path"],)
+                            for folder_path in targets:
+                                file_path = os.path.join(folder_path, file_name)
+                                if os.path.exists(file_path):
+                                    print(f"File {file_path} already exists. Overwriting.")
+                            writes[process_executor.submit(
+                                _process_project, row, response, file_name, targets, use_arrow=use_arrow)] = response
+                        else:
+                            # transformData closes the response, this covers earlier failures
+                            writes.pop(future).close()
+                            future.result()
+                            completed += 1
+                            update_progress_bar(total=total_rows, progress=completed, color="white")
+            except BaseException:
+                # stop at the first failing project instead of waiting for every queued request
+                fetch_executor.shutdown(wait=False, cancel_futures=True)
+                process_executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    finally:
+        _close_unread_responses(fetches, writes)
     create_typing_effect("\n\n\n RedCap Extraction Completed.", delay=0, color="green")
 
 
@@ -0,0 +1,84 @@
+"""
+redcapUtils.py
+
+Helpers shared by setupRC.py and extractRedcaps.py:
+- The REDCap API endpoint.
+- A single requests.Session so TLS/TCP connections to REDCap are reused between API calls.
+- Reading and writing the project metadata CSV.
+"""
+import csv
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+REDCAP_API_URL = "https://redcap.fiu.edu/api/"
+# connections kept open to REDCap by the shared session
+POOL_SIZE = 16
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the shared requests.Session, creating it on first use.
+    API calls run on worker threads, so creation is guarded by a lock.
+
+    :return: requests.Session with a pooled HTTPS adapter
+    """
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                session = requests.Session()
+                session.mount("https://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+                _SESSION = session
+    return _SESSION
+
+
+def read_metadata(file_path):
+    """
+    Reads the project metadata CSV. The file is small and only iterated, so the csv module is used.
+
+    :param file_path: Path to the metadata CSV file
+    :return: Tuple of the header's column names and a list of dicts, one per project, with string values
+    """
+    with open(file_path, "r", newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames or []
+        # DictReader keeps only the last cell of a repeated column, so writing back would lose data
+        if len(set(fieldnames)) != len(fieldnames):
+            duplicates = sorted({name for name in fieldnames if fieldnames.count(name) > 1})
+            raise ValueError(f"{file_path} has duplicate columns: {', '.join(duplicates)}")
+        rows = []
+        for row in reader:
+            # DictReader files cells beyond the header under a None key
+            if None in row:
+                raise ValueError(f"Line {reader.line_num} of {file_path} has more cells than the header.")
+            rows.append(row)
+        return fieldnames, rows
+
+
+def write_metadata(file_path, fieldnames, rows):
+    """
+    Writes the project metadata CSV back with LF line endings, as pandas did.
+
+    :param file_path: Path to the metadata CSV file
+    :param fieldnames: Column names in output order
+    :param rows: List of dicts, one per project
+    """
+    with open(file_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def is_true(value):
+    """
+    Interprets a metadata CSV cell as a boolean, accepting True/TRUE/true.
+
+    :param value: Cell value, usually a string
+    :return: True if the cell spells true
+    """
+    return str(value).strip().lower() == "true"
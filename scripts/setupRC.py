@@ -2,11 +2,24 @@ import subprocess
 import sys
 import argparse
 import os
-import pandas as pd
+import re
+import shutil
+import tempfile
 import platform
 from cryptography.fernet import Fernet
-from io import StringIO
-import requests
+from concurrent.futures import ThreadPoolExecutor
+# works both as part of the scripts package and when run from inside scripts/
+try:
+    from .redcapUtils import REDCAP_API_URL, get_session, is_true, read_metadata, write_metadata
+except ImportError:
+    from redcapUtils import REDCAP_API_URL, get_session, is_true, read_metadata, write_metadata
+
+REQUIRED_COLUMNS = frozenset({"project_name", "project_type", "API_Token", "folder_path", "encrypted"})
+# columns understood by extractRedcaps that are not required here
+OPTIONAL_COLUMNS = frozenset({"custom_name"})
+# number of concurrent token validation requests
+MAX_WORKERS = 8
+
 
 """ Module for transforming basic CSV to REDCap ETL setup CSV format.
 Performs: 
@@ -33,26 +46,27 @@ def parseArgs():
     return parser.parse_args()
 
 
-def encrypt_token(token, key):
+def encrypt_token(token, cipher):
     if token is None or token == "":
         raise ValueError("API token cannot be empty for encryption.")
-    cipher = Fernet(key)
     encrypted_token = cipher.encrypt(token.encode()).decode()
     return encrypted_token
 
-def decrypt_token(encrypted_token, key):
-    cipher = Fernet(key)
+def decrypt_token(encrypted_token, cipher):
     decrypted_token = cipher.decrypt(encrypted_token).decode()
     return decrypted_token
-def checkColumns(df):
-    required_columns = ["project_name", "project_type", "API_Token", "folder_path", "encrypted"]
-    for col in df.columns:
-        if col in required_columns:
-            required_columns.remove(col)
-        else:
-            print(f"Warning: Unexpected column '{col}' found in the input.")
-    if required_columns:
-        raise ValueError(f"Missing required columns: {', '.join(required_columns)}")
+def checkColumns(columns):
+    # a set would silently collapse repeated names, so report them first
+    duplicates = sorted({col for col in columns if columns.count(col) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate columns found in the input: {', '.join(duplicates)}")
+    actual_columns = set(columns)
+    missing = REQUIRED_COLUMNS - actual_columns
+    extra = actual_columns - REQUIRED_COLUMNS - OPTIONAL_COLUMNS
+    if extra:
+        print(f"Warning: Unexpected columns found in the input: {', '.join(sorted(extra))}")
+    if missing:
+        raise ValueError(f"Missing required columns: {', '.join(sorted(missing))}")
     print("All required columns are present.")
 def set_encryption_key(keyName: str = "REDCAP_ENCRYPTION_KEY", value: str = None):
     system = platform.system()
@@ -66,10 +80,22 @@ def set_encryption_key(keyName: str = "REDCAP_ENCRYPTION_KEY", value: str = None
             )
 
         elif system in ("Linux", "Darwin"):
-            shell_rc = os.path.expanduser("~/.bashrc")
+            # resolve symlinks so a managed dotfile is updated rather than replaced
+            shell_rc = os.path.realpath(os.path.expanduser("~/.bashrc"))
+            content = ""
+            if os.path.exists(shell_rc):
+                with open(shell_rc, "r", encoding="utf-8") as f:
+                    content = f.read()
 
-            with open(shell_rc, "a", encoding="utf-8") as f:
-                f.write(f'\nexport {keyName}="{value}"\n')
+            # replace an existing export of the key instead of appending a duplicate
+            export_line = f'export {keyName}="{value}"'
+            export_re = re.compile(rf'^export {re.escape(keyName)}=.*$', re.M)
+            if export_re.search(content):
+                new_content = export_re.sub(lambda m: export_line, content)
+            else:
+                new_content = f'{content}\n{export_line}\n'
+            if new_content != content:
+                write_file_atomic(shell_rc, new_content)
 
         else:
             raise RuntimeError(f"Unsupported OS: {system}")
@@ -77,17 +103,34 @@ def set_encryption_key(keyName: str = "REDCAP_ENCRYPTION_KEY", value: str = None
     except (subprocess.CalledProcessError, OSError) as e:
         raise RuntimeError(f"Failed to persist {keyName}") from e
 
+def write_file_atomic(file_path, content):
+    # write to a temp file in the same directory, then swap it in with os.replace
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=".redcap-etl-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 def validateAPIToken(survey_name,API_token):
-    url = "https://redcap.fiu.edu/api/"
     data = {
     "token": API_token,
     "content": "project",
-    "format": "csv",
+    "format": "json",
     }
 
-    response = requests.post(url, data=data)
-    metadataDF = pd.read_csv(StringIO(response.text))
-    expected_survey_name =  metadataDF.iloc[0]["project_title"]
+    response = get_session().post(REDCAP_API_URL, data=data)
+    if response.status_code != 200:
+        raise ValueError(f"API token is invalid for survey {survey_name}: {response.status_code} - {response.text}")
+    project_info = response.json()
+    # project info is a single JSON object; accept a one-element list as well
+    if isinstance(project_info, list):
+        project_info = project_info[0]
+    expected_survey_name = project_info["project_title"]
     if expected_survey_name != survey_name:
         raise ValueError(f"API token is invalid for survey {survey_name}. Expected survey name: {expected_survey_name}")
 
@@ -108,17 +151,20 @@ def main(args):
             raise ValueError("Decryption key must be a base64-encoded 32-byte string.")
     else:
         key = create_encryptedKey()
-    input_df = pd.read_csv(args.input)
-    checkColumns(input_df)
-    for index, row in input_df.iterrows():
-        if row["encrypted"] == False or pd.isna(row["encrypted"]):
-            validateAPIToken(row["project_name"], row["API_Token"])
-            print(f"Encrypting token for project: {row['project_name']}")
-            encrypted_token = encrypt_token(row["API_Token"], key)
-            #encrypted_token = decrypt_token(row["API_Token"], key)
-            input_df.at[index, "API_Token"] = encrypted_token
-            input_df.at[index, "encrypted"] = True
-    input_df.to_csv(args.input, index=False)
+    cipher = Fernet(key.encode() if isinstance(key, str) else key)
+    fieldnames, rows = read_metadata(args.input)
+    checkColumns(fieldnames)
+    to_encrypt = [row for row in rows if not is_true(row["encrypted"])]
+    # validate all tokens against REDCap concurrently before encrypting any of them
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(lambda row: validateAPIToken(row["project_name"], row["API_Token"]), to_encrypt))
+    for row in to_encrypt:
+        print(f"Encrypting token for project: {row['project_name']}")
+        encrypted_token = encrypt_token(row["API_Token"], cipher)
+        #encrypted_token = decrypt_token(row["API_Token"], cipher)
+        row["API_Token"] = encrypted_token
+        row["encrypted"] = True
+    write_metadata(args.input, fieldnames, rows)
     
 if __name__ == "__main__":
     args = parseArgs()